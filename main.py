@@ -5,12 +5,21 @@
 # Additional Developers: Dr. Jonathan J. Keats, Dr. Christophe Legendre, Bryce Turner, Daniel Enriquez
 
 import argparse
+import asyncio
+import contextlib
+import functools
+import gzip
+import multiprocessing
 import pandas as pd
 import os
+import re
+import signal
 import sys
+import time
 import scipy
 from gtfparse import read_gtf
 from subprocess import call
+from collections import Counter
 from scipy import stats
 
 # shell=True is so you can handle redirects
@@ -21,8 +30,9 @@ call("echo 'Running'", shell=True)
 parser = argparse.ArgumentParser(description='Check purity of multiple myeloma tumor samples.')
 # Add input argument for BAM file from patient/sample. This is required for the program.
 parser.add_argument('-i', '--input_bam',
-                    required=True,
-                    help='BAM file for tumor sample')
+                    nargs='+',
+                    help='BAM file for tumor sample. Several files may be given to process a queue of samples, '
+                         'which are pipelined through the conversion, counting and plotting stages concurrently')
 # Add input argument for GTF file containing regions to isolate.
 parser.add_argument('-g', '--input_gtf',
                     help='GTF to be used in processing')
@@ -65,6 +75,33 @@ parser.add_argument('-d', '--resource_directory',
 parser.add_argument('-build_only', '--build_only',
                     action='store_true',
                     help='Invoke -build_only to stop the program after the new GTF is built.')
+# Add input argument for additional annotations to count against in the same featureCounts pass. Each is given as
+# LABEL=/path/to/file.gtf and the argument may be repeated.
+parser.add_argument('-a', '--annotation',
+                    action='append',
+                    metavar='LABEL=GTF',
+                    help='Additional annotation to count against in the same pass over the alignment, given as '
+                         'LABEL=/path/to/file.gtf. May be repeated. Results are written for each label, and for the '
+                         'default, custom (-g) or built (-b) GTF under the label "primary"')
+# Add input argument for raw FASTQ files to run the alignment-free fast screen on instead of an alignment.
+parser.add_argument('-q', '--fastq',
+                    nargs='+',
+                    help='FASTQ or FASTQ.gz file(s) of a single sample (e.g. both files of a pair) to run the '
+                         'alignment-free fast screen on, instead of an alignment file. Requires -f')
+parser.add_argument('-screen_kmer', '--screen_kmer',
+                    default=25,
+                    type=int,
+                    help='K-mer size used by the fast screen. Default is 25')
+# Add input arguments for the number of I/O-bound (CRAM conversion, plotting) and CPU-bound (featureCounts,
+# interpretation) stages allowed to run at once when several samples are processed.
+parser.add_argument('-io_jobs', '--io_jobs',
+                    default=1,
+                    type=int,
+                    help='Number of I/O-bound stages (CRAM conversion, plotting) to run at once. Default is 1')
+parser.add_argument('-cpu_jobs', '--cpu_jobs',
+                    default=1,
+                    type=int,
+                    help='Number of CPU-bound stages (featureCounts, interpretation) to run at once. Default is 1')
 
 # Generate accessible arguments by calling parse_args
 args = parser.parse_args()
@@ -72,7 +109,7 @@ args = parser.parse_args()
 # Rename each input to something shorter and more intuitive for later use in the code.
 out_path = args.output_path
 in_gtf = args.input_gtf
-input_aln = args.input_bam
+input_alns = args.input_bam
 build = args.build_files
 threads = args.threads
 keep_temp = args.keep_temp
@@ -80,12 +117,67 @@ samplename = args.sample_name
 resource_directory = args.resource_directory
 ref_fasta = args.reference_fasta
 build_only = args.build_only
+io_jobs = args.io_jobs
+cpu_jobs = args.cpu_jobs
+extra_annotations = args.annotation
+fastqs = args.fastq
+screen_kmer = args.screen_kmer
+
+# Exactly one of an alignment (-i) or FASTQ files for the fast screen (-q) must be given.
+if input_alns is None and fastqs is None:
+    sys.exit('ERROR: An input alignment file (-i) or FASTQ files for the fast screen (-q) must be provided.')
+elif input_alns is not None and fastqs is not None:
+    sys.exit('ERROR: -i and -q cannot be used together.')
+elif fastqs is not None and ref_fasta is None:
+    sys.exit('ERROR: The fast screen requires a Reference Genome Fasta File (-f) to build its k-mer index.')
+elif fastqs is not None and extra_annotations is not None:
+    sys.exit('ERROR: Additional annotations (-a) are not supported by the fast screen.')
+elif screen_kmer < 1:
+    sys.exit('ERROR: The k-mer size of the fast screen (-screen_kmer) must be at least 1.')
+elif fastqs is not None and not os.path.exists('%s.fai' % ref_fasta):
+    sys.exit('ERROR: The fast screen requires the FAI index of the Reference Genome Fasta File (samtools faidx).')
 
 # This statement sets the sample name to the name of the BAM if no name is provided, using os.basename to extract the
 # file name from the input path and os.splitext to split the name into ('filename', 'extension'),
 # e.g. ('example', '.txt). The [0] accesses the first string in that output (the file name w/o extension).
-if samplename is None:
-    samplename = os.path.splitext(os.path.basename(input_aln))[0]
+# For the fast screen, the name of the first FASTQ is used once its .gz and .fastq/.fq extensions are removed.
+if samplename is None and fastqs is not None:
+    samplename = os.path.basename(fastqs[0])
+    for extension in ('.gz', '.fastq', '.fq'):
+        if samplename.endswith(extension):
+            samplename = samplename[:-len(extension)]
+elif samplename is None:
+    samplename = os.path.splitext(os.path.basename(input_alns[0]))[0]
+
+# Split each additional annotation into its label and GTF. Labels are used in file names and to tag gene names in the
+# merged GTF, so they must be unique and may only contain letters, digits, '_', '.' and '-'.
+annotation_sets = []
+if extra_annotations is not None:
+    for annotation in extra_annotations:
+        label, separator, annotation_path = annotation.partition('=')
+        if separator == '' or label == '' or annotation_path == '':
+            sys.exit('ERROR: Annotations must be given as LABEL=/path/to/file.gtf, got %s' % annotation)
+        if label == 'primary' or re.fullmatch(r'[A-Za-z0-9_.-]+', label) is None:
+            sys.exit('ERROR: Invalid annotation label %s; labels may only contain letters, digits, _, . and -, '
+                     'and primary is reserved' % label)
+        if label in [existing_label for existing_label, existing_path in annotation_sets]:
+            sys.exit('ERROR: Annotation label %s was given more than once' % label)
+        annotation_sets.append((label, annotation_path))
+
+# When a single alignment is given, the sample name above applies to it. When several are given, each sample is named
+# after its own file, and the name above is only used for a GTF built with -b.
+if input_alns is None or len(input_alns) == 1:
+    sample_names = [samplename]
+else:
+    sample_names = [os.path.splitext(os.path.basename(aln))[0] for aln in input_alns]
+    # Samples run at the same time and write their files under their names, so the names must be unique. Aligners
+    # often give every sample the same file name (e.g. STAR's Aligned.sortedByCoord.out.bam), in which case the name
+    # of the directory holding the file is added in front.
+    if len(set(sample_names)) != len(sample_names):
+        sample_names = ['%s_%s' % (os.path.basename(os.path.dirname(os.path.abspath(aln))), name)
+                        for aln, name in zip(input_alns, sample_names)]
+    if len(set(sample_names)) != len(sample_names):
+        sys.exit('ERROR: Several input files would get the same sample name; please rename or move them.')
 
 # ----------------------------------------- #
 #  DEFAULTS
@@ -105,47 +197,167 @@ featurecounts_path = default_parameters[8]
 # FUNCTIONS THAT SUPPORT CODE AT BOTTOM
 # ------------------------------------------------------------------------------------------------------------------- #
 
-def read_aln_file(filename, threads, out_path, reference_genome_fasta=None):
-    """
-    read the alignment file whether it is a SAM, BAM or CRAM file and returns the bam file handle
-    :return: aln read file handle (bamh or alnh)
+class StageScheduler:
     """
+    Runs the stages of several samples at once on an asyncio event loop, so that one sample can be converted while
+    another is being counted and a third is being plotted. External tools are started as asyncio subprocesses and
+    Python stages (e.g. interpret_featurecounts) are run in a worker thread.
 
-    extension = os.path.splitext(filename)[1]
-    basepath = os.path.splitext(filename)[0]
-    basename = os.path.splitext(os.path.basename(filename))[0]
-    try:
-        if extension == ".cram":
-            if reference_genome_fasta is None:
-                raise FileNotFoundError(
-                    "ERROR: reading CRAM file requires a Reference Genome Fasta File To be Provided with its FAI index.")
-            print('Conversion to BAM required: running samtools')
-            call("samtools view --threads %s -bh %s -o %s/%s.bam -T %s" % (threads, filename, out_path, basename,
-                                                                        reference_genome_fasta), shell=True)
-            print('Indexing new BAM file')
-            call("samtools index -@ %s -b %s/%s.bam" % (threads, out_path, basename), shell=True)
-            print('Conversion successful')
-            return '%s/%s.bam' % (out_path, basename)
-        elif extension == ".bam":
-            return filename
-        elif extension == ".sam":
-            return filename
-        else:
-            print('ERROR: HALTING PROGRAM AND RETURNING VARIABLES FOR DEBUGGING')
-            print('FILENAME:' + filename)
-            print('REFERENCE FASTA:' + reference_genome_fasta)
-            print('THREADS:' + threads)
-            print('EXTENSION:' + extension)
-            print('BASE PATH:' + basepath)
-            print('BASE NAME:' + basename)
+    Stages are either 'io' (CRAM conversion, plotting) or 'cpu' (featureCounts, interpretation), and each kind has its
+    own limit on how many stages may run at once. On top of that, every stage reserves a number of threads from a
+    global budget (the -t value) before starting, so that the tools running at any moment never use more threads than
+    the user made available.
 
-            sys.exit("EXPECTED EXTENSION for ALIGNMENT FILE NOT FOUND; must be either .cram, .bam or .sam")
+    Queue metrics are kept for each stage: number of jobs, the longest queue seen, and the time spent waiting and
+    running. They can be printed with report().
 
-    except FileNotFoundError as fnf:
-        sys.exit(fnf)
+    The scheduler must be created inside the running event loop (i.e. from a coroutine passed to asyncio.run).
 
-    except Exception as e:
-        sys.exit(e)
+    :param thread_budget: The total number of threads the running stages may use at once.
+    :param io_jobs: The number of I/O-bound stages allowed to run at once.
+    :param cpu_jobs: The number of CPU-bound stages allowed to run at once.
+    """
+
+    def __init__(self, thread_budget, io_jobs=1, cpu_jobs=1):
+        self.thread_budget = max(1, thread_budget)
+        self.free_threads = self.thread_budget
+        self.thread_condition = asyncio.Condition()
+        self.limits = {'io': asyncio.Semaphore(max(1, io_jobs)), 'cpu': asyncio.Semaphore(max(1, cpu_jobs))}
+        self.metrics = {}
+
+    @contextlib.asynccontextmanager
+    async def stage(self, name, kind, threads=1):
+        """
+        Wait for a free slot of the given kind and enough threads from the budget, then hold them while the body of
+        the "async with" block runs.
+
+        :param name: The name of the stage, used to group the queue metrics.
+        :param kind: 'io' or 'cpu'.
+        :param threads: The number of threads the stage takes from the budget. Clamped to the global budget. Stages
+        that do not run a multi-threaded tool (interpretation, plotting) take 0, so they can overlap with the tools
+        even when the budget is a single thread.
+        """
+        threads = min(max(0, threads), self.thread_budget)
+        metrics = self.metrics.setdefault(name, {'kind': kind, 'jobs': 0, 'queued': 0, 'max_queued': 0,
+                                                 'wait_seconds': 0.0, 'run_seconds': 0.0})
+        metrics['queued'] += 1
+        metrics['max_queued'] = max(metrics['max_queued'], metrics['queued'])
+        queued_at = time.monotonic()
+
+        # The stage leaves the queue either when it starts or when it is cancelled while waiting
+        waiting = True
+        try:
+            async with self.limits[kind]:
+                async with self.thread_condition:
+                    await self.thread_condition.wait_for(lambda: self.free_threads >= threads)
+                    self.free_threads -= threads
+                metrics['queued'] -= 1
+                waiting = False
+                started_at = time.monotonic()
+                metrics['wait_seconds'] += started_at - queued_at
+                try:
+                    yield threads
+                finally:
+                    metrics['jobs'] += 1
+                    metrics['run_seconds'] += time.monotonic() - started_at
+                    async with self.thread_condition:
+                        self.free_threads += threads
+                        self.thread_condition.notify_all()
+        finally:
+            if waiting:
+                metrics['queued'] -= 1
+
+    async def run_command(self, name, kind, command, threads=1):
+        """
+        Run a shell command as a stage. The shell is used so that redirects keep working, as with subprocess.call.
+
+        :param name: The name of the stage.
+        :param kind: 'io' or 'cpu'.
+        :param command: The shell command to run.
+        :param threads: The number of threads the command was told to use.
+        :return: The return code of the command.
+        """
+        async with self.stage(name, kind, threads):
+            # The command gets its own process group so that everything the shell started can be killed with it
+            process = await asyncio.create_subprocess_shell(command, start_new_session=True)
+            try:
+                return await process.wait()
+            except asyncio.CancelledError:
+                # Do not leave the command running unattended, e.g. after Ctrl-C
+                if process.returncode is None:
+                    os.killpg(process.pid, signal.SIGKILL)
+                raise
+
+    async def run_function(self, name, kind, function, *args, threads=1):
+        """
+        Run a Python function as a stage in the event loop's default thread pool.
+
+        :param name: The name of the stage.
+        :param kind: 'io' or 'cpu'.
+        :param function: The function to call.
+        :param args: Positional arguments passed to the function.
+        :param threads: The number of threads the function will use.
+        :return: The return value of the function.
+        """
+        async with self.stage(name, kind, threads):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, functools.partial(function, *args))
+
+    def report(self):
+        """
+        Print the queue metrics of every stage as a tab-separated table.
+        """
+        print('Stage\tType\tJobs\tMax_Queued\tMean_Wait_s\tMean_Run_s')
+        for name, metrics in self.metrics.items():
+            jobs = max(metrics['jobs'], 1)
+            print('%s\t%s\t%s\t%s\t%.2f\t%.2f' % (name, metrics['kind'], metrics['jobs'], metrics['max_queued'],
+                                                  metrics['wait_seconds'] / jobs, metrics['run_seconds'] / jobs))
+
+
+async def read_aln_file(scheduler, filename, samplename, threads, out_path, reference_genome_fasta=None):
+    """
+    read the alignment file whether it is a SAM, BAM or CRAM file and returns the path of a BAM or SAM file that
+    featureCounts can read. CRAM files are converted to out_path/samplename.bam as an I/O stage of the scheduler, so
+    that samples whose files share a name do not convert to the same BAM.
+    :return: aln read file path (bam or aln)
+    """
+
+    extension = os.path.splitext(filename)[1]
+    basename = samplename
+    if extension == ".cram":
+        if reference_genome_fasta is None:
+            raise FileNotFoundError(
+                "ERROR: reading CRAM file requires a Reference Genome Fasta File To be Provided with its FAI index.")
+        print('%s: Conversion to BAM required: running samtools' % basename)
+        try:
+            returncode = await scheduler.run_command('samtools_view', 'io',
+                                                     "samtools view --threads %s -bh %s -o %s/%s.bam -T %s"
+                                                     % (threads, filename, out_path, basename, reference_genome_fasta),
+                                                     threads)
+            if returncode != 0:
+                raise RuntimeError("samtools view exited with status %s for %s" % (returncode, filename))
+            print('%s: Indexing new BAM file' % basename)
+            returncode = await scheduler.run_command('samtools_index', 'io',
+                                                     "samtools index -@ %s -b %s/%s.bam"
+                                                     % (threads, out_path, basename),
+                                                     threads)
+            if returncode != 0:
+                raise RuntimeError("samtools index exited with status %s for %s" % (returncode, filename))
+        except BaseException:
+            # Do not leave a partial BAM or index behind when the conversion fails or is cancelled
+            for partial_file in ('%s/%s.bam' % (out_path, basename), '%s/%s.bam.bai' % (out_path, basename)):
+                if os.path.exists(partial_file):
+                    os.remove(partial_file)
+            raise
+        print('%s: Conversion successful' % basename)
+        return '%s/%s.bam' % (out_path, basename)
+    elif extension == ".bam":
+        return filename
+    elif extension == ".sam":
+        return filename
+    else:
+        raise ValueError("EXPECTED EXTENSION for ALIGNMENT FILE NOT FOUND; must be either .cram, .bam or .sam: %s"
+                         % filename)
 
 
 def isolate_ig(dataframe, contaminant_list, loci, chromosome_list=default_chromosome_list,
@@ -229,7 +441,7 @@ def isolate_ig(dataframe, contaminant_list, loci, chromosome_list=default_chromo
     return ig_dataframe
 
 
-def interpret_featurecounts(filepath, resource_directory, samplename):
+def interpret_featurecounts(filepath, resource_directory, samplename, annotation_label=None, screening=False):
     """
 
 	This function takes the output from featureCounts's operation on the input BAM and GTF files and creates
@@ -243,22 +455,35 @@ def interpret_featurecounts(filepath, resource_directory, samplename):
 	:param filepath: The directory in which the files built here will be deposited
 	:param resource_directory: The directory from which the files used here will be sourced.
 	:param samplename: The name of the sample.
+	:param annotation_label: The label of the annotation variant the counts belong to, if several annotations were
+	counted at once. When given, the files read and written here are prefixed with samplename_label instead of
+	samplename, and an "Annotation" column holding the label is added to the results.
+	:param screening: True if the counts come from the alignment-free fast screen (screen_fastq) rather than
+	featureCounts. The results are then written to samplenamefastScreenResults.txt, with a "Mode" column, and the
+	plot titles are marked as a screening result.
 	:return: No return, but several files will be written by the function.
 	"""
 
+    # Files of an annotation variant are prefixed with its label so that the variants of a sample do not overwrite
+    # each other.
+    if annotation_label is None:
+        fileprefix = samplename
+    else:
+        fileprefix = '%s_%s' % (samplename, annotation_label)
+
     # Create dataframe called "reads" by importing the output from featurecounts. First row is skipped in the import
     # since it is just a header, second row is used to generate column labels. Tab-separated and new-line-terminated
     # are specified to ensure a proper read (the output dataframe will be one column or row if not specified)
 
     # filepath is used here instead of resource directory because featurecounts will write its output to the
     # directory specified by filepath
-    reads = pd.read_csv(r'%s/%s.txt' % (filepath, samplename), sep='\t', lineterminator='\n',
+    reads = pd.read_csv(r'%s/%s.txt' % (filepath, fileprefix), sep='\t', lineterminator='\n',
                         skiprows=(0), header=(1))
     # Rename the column containing the counts to "Count". For whatever reason it comes labeled with the input file path.
     reads.rename(columns={reads.columns[6]: "Count"}, inplace=True)
 
     # Read in featurecounts's summary file
-    summary = pd.read_csv(r'%s/%s.txt.summary' % (filepath, samplename), sep='\t',
+    summary = pd.read_csv(r'%s/%s.txt.summary' % (filepath, fileprefix), sep='\t',
                           lineterminator='\n', skiprows=(0), header=(0))
     # Rename the Count column, since it is given a long and unweildy name by default.
     summary.rename(columns={summary.columns[1]: "Count"}, inplace=True)
@@ -382,9 +607,9 @@ def interpret_featurecounts(filepath, resource_directory, samplename):
     Graph_IgH.columns = ['CommonName', 'Count', 'Percentage', 'TotalFrequency', 'Locus', 'ElementSize']
 
     # Write these tables to a tab-delimited text file. R will use these files to plot
-    Graph_IgH.to_csv(r'%s/%sGraph_IgH.txt' % (filepath, samplename), sep='\t', float_format='%.12f',
+    Graph_IgH.to_csv(r'%s/%sGraph_IgH.txt' % (filepath, fileprefix), sep='\t', float_format='%.12f',
                      index=False)
-    Graph_IgL.to_csv(r'%s/%sGraph_IgL.txt' % (filepath, samplename), sep='\t', float_format='%.12f',
+    Graph_IgL.to_csv(r'%s/%sGraph_IgL.txt' % (filepath, fileprefix), sep='\t', float_format='%.12f',
                      index=False)
 
     # This function returns a list of primary information from the input dataframe, e.g. when given IGHC_Calc, etc.
@@ -539,9 +764,22 @@ def interpret_featurecounts(filepath, resource_directory, samplename):
                     str(Total_Light_Constant), str(Percent_Kappa), str(Percent_Lambda), str(Top1), str(Top2),
                     str((Top1_Delta + Top2_Delta) / 2), str(geomean), clonality]
 
+    # Record which annotation variant produced the results when several were counted at once.
+    if annotation_label is not None:
+        label_list.append("Annotation")
+        results_list.append(annotation_label)
+
+    # Flag results of the fast screen so they are not mistaken for results of a full alignment
+    if screening is True:
+        label_list.append("Mode")
+        results_list.append("FastScreen")
+        resultsname = 'fastScreenResults'
+    else:
+        resultsname = 'purityCheckerResults'
+
     # This block of code opens a new text file, writes the first list into the file tab-separated, then writes
     # a new line, and does the same for the list of results.
-    resultstextfile = open(r"%s/%spurityCheckerResults.txt" % (filepath, samplename), "w")
+    resultstextfile = open(r"%s/%s%s.txt" % (filepath, fileprefix, resultsname), "w")
     for element in label_list:
         resultstextfile.write(element + "\t")
     resultstextfile.write("\n")
@@ -549,7 +787,11 @@ def interpret_featurecounts(filepath, resource_directory, samplename):
         resultstextfile.write(element + "\t")
     resultstextfile.close()
 
-    titletextfile = open(r"%s/%stitle.txt" % (filepath, samplename), "w")
+    titletextfile = open(r"%s/%stitle.txt" % (filepath, fileprefix), "w")
+    if screening is True:
+        titletextfile.write("FAST SCREEN (alignment-free, preliminary) ; ")
+    if annotation_label is not None:
+        titletextfile.write("Annotation = %s ; " % annotation_label)
     titletextfile.write("Percent Ig = %s ; Kappa/(K+L) = %s ; Lambda/(K+L) = %s ; Non B Contamination = %s"
                         % (str(round(Percent_IG, 4)), str(round(Percent_Kappa, 4)), str(round(Percent_Lambda, 4)),
                            str(geomean)))
@@ -605,12 +847,494 @@ def writeGTF(inGTF, file_path):
     print('GTF conversion complete')
 
 
+def merge_annotations(annotation_sets, file_path):
+    """
+    Write one GTF containing every annotation variant, so that featureCounts can assign each read to all of them in a
+    single pass over the alignment. The gene_name of every feature is prefixed with the label of its variant (e.g.
+    IGKC becomes primary::IGKC), which keeps the genes of each variant apart in the counts. Since featureCounts is run
+    with -O, a read overlapping the same gene in several variants is counted once for each of them, exactly as if each
+    GTF had been counted on its own.
+
+    :param annotation_sets: A list of (label, path/to/file.gtf) tuples.
+    :param file_path: path/to/the/merged.gtf
+    :returns: nothing
+    """
+    with open(r'%s' % file_path, 'w', encoding='utf-8') as merged:
+        for label, annotation_path in annotation_sets:
+            with open(r'%s' % annotation_path, 'r', encoding='utf-8') as annotation:
+                for line in annotation:
+                    # Skip header comments, they may only appear at the top of a GTF
+                    if line.startswith('#'):
+                        continue
+                    # Keep the last line of one GTF from running into the first line of the next
+                    if not line.endswith('\n'):
+                        line = line + '\n'
+                    merged.write(line.replace('gene_name "', 'gene_name "%s::' % label))
+
+
+def split_featurecounts(filepath, samplename, labels):
+    """
+    Split the output of a featureCounts run on a GTF written by merge_annotations into one output per annotation
+    variant, named samplename_label.txt and samplename_label.txt.summary, in the format interpret_featurecounts reads.
+    The gene counts are those featureCounts would give for that variant alone.
+
+    The Assigned and Unassigned_NoFeatures lines of the merged summary describe the merged annotation, not any one
+    variant, so they are replaced in each variant's summary by a single Assigned_Or_Unassigned_NoFeatures line holding
+    their sum. That sum, every read that passed featureCounts's filters, is all interpret_featurecounts uses and does
+    not depend on the annotation. The other Unassigned lines (mapping quality, multi-mapping, etc.) do not depend on
+    the annotation either and are copied as they are.
+
+    :param filepath: The directory holding the featureCounts output, where the split files will also be written.
+    :param samplename: The name of the sample.
+    :param labels: The labels of the annotation variants.
+    :return: No return, but two files will be written for each label.
+    """
+    with open(r'%s/%s.txt' % (filepath, samplename), 'r') as counts:
+        # The first line is the featureCounts command and the second holds the column labels
+        program_line = counts.readline()
+        header_line = counts.readline()
+        variant_lines = {label: [] for label in labels}
+        for line in counts:
+            label, separator, gene_line = line.partition('::')
+            if label in variant_lines:
+                variant_lines[label].append(gene_line)
+
+    with open(r'%s/%s.txt.summary' % (filepath, samplename), 'r') as summary:
+        summary_header = summary.readline()
+        filtered_lines = []
+        assigned_or_no_features = 0
+        for line in summary:
+            status, separator, count = line.rstrip('\n').partition('\t')
+            if status in ('Assigned', 'Unassigned_NoFeatures'):
+                assigned_or_no_features += int(count)
+            else:
+                filtered_lines.append(line)
+
+    for label in labels:
+        with open(r'%s/%s_%s.txt' % (filepath, samplename, label), 'w') as variant_counts:
+            variant_counts.write(program_line)
+            variant_counts.write(header_line)
+            variant_counts.writelines(variant_lines[label])
+        with open(r'%s/%s_%s.txt.summary' % (filepath, samplename, label), 'w') as variant_summary:
+            variant_summary.write(summary_header)
+            variant_summary.write('Assigned_Or_Unassigned_NoFeatures\t%s\n' % assigned_or_no_features)
+            variant_summary.writelines(filtered_lines)
+
+
+def read_exons(gtf_path, gene_names=None):
+    """
+    Read the exons of a GTF without building a dataframe, for use by the fast screen.
+
+    :param gtf_path: path/to/the/file.gtf
+    :param gene_names: An optional set of gene names. If given, only exons of these genes are returned.
+    :return: A list of (seqname, start, end, gene_name) tuples, with 1-based inclusive coordinates as in the GTF.
+    """
+    exons = []
+    with open(r'%s' % gtf_path, 'r') as gtf:
+        for line in gtf:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 9 or fields[2] != 'exon' or 'gene_name "' not in fields[8]:
+                continue
+            gene_name = fields[8].split('gene_name "')[1].split('"')[0]
+            if gene_names is None or gene_name in gene_names:
+                exons.append((fields[0], int(fields[3]), int(fields[4]), gene_name))
+    return exons
+
+
+# Reverse complement table for the fast screen. Only A, C, G, T and N are complemented; other characters (e.g. IUPAC
+# codes) are left as they are, which is harmless since the index only holds k-mers made of A, C, G and T.
+COMPLEMENT = str.maketrans('ACGTacgtn', 'TGCATGCAN')
+
+
+def read_fasta_index(reference_genome_fasta):
+    """
+    Read the FAI index (reference.fa.fai, as written by samtools faidx) of the reference FASTA.
+
+    :param reference_genome_fasta: path/to/the/reference.fa
+    :return: A dictionary mapping each sequence name, without a leading 'chr', to a tuple (length, offset, line
+    bases, line width) giving where its sequence starts in the FASTA and how its lines are laid out.
+    """
+    if not os.path.exists('%s.fai' % reference_genome_fasta):
+        raise FileNotFoundError("The fast screen requires the FAI index of %s; create it with samtools faidx."
+                                % reference_genome_fasta)
+    fasta_index = {}
+    with open(r'%s.fai' % reference_genome_fasta, 'r') as fai:
+        for line in fai:
+            fields = line.split('\t')
+            fasta_index[fields[0].replace('chr', '', 1)] = (int(fields[1]), int(fields[2]), int(fields[3]),
+                                                            int(fields[4]))
+    return fasta_index
+
+
+def fetch_region(fasta, fasta_index_entry, start, end):
+    """
+    Read one region of a sequence from an open FASTA file, seeking to it with the sequence's FAI entry.
+
+    :param fasta: The reference FASTA, opened in binary mode.
+    :param fasta_index_entry: The (length, offset, line bases, line width) tuple of the sequence.
+    :param start: The 1-based start of the region.
+    :param end: The 1-based, inclusive end of the region. Clamped to the length of the sequence.
+    :return: The upper-case sequence of the region, with every character other than A, C, G and T replaced by N.
+    """
+    length, offset, line_bases, line_width = fasta_index_entry
+    end = min(end, length)
+    if end < start:
+        return ''
+    first = offset + (start - 1) // line_bases * line_width + (start - 1) % line_bases
+    last = offset + (end - 1) // line_bases * line_width + (end - 1) % line_bases
+    fasta.seek(first)
+    region = fasta.read(last - first + 1).decode('ascii').replace('\n', '').replace('\r', '').upper()
+    return re.sub('[^ACGT]', 'N', region)
+
+
+def build_kmer_index(exons, reference_genome_fasta, kmer_size):
+    """
+    Build the k-mer index used by the fast screen from the exon sequences of the given genes. K-mers are stored in
+    canonical form (the smaller of the k-mer and its reverse complement), so reads can be matched on either strand.
+    K-mers found in more than one gene are kept with the value -1, so that reads hitting them are not credited to
+    either gene. K-mers holding anything other than A, C, G and T (N or IUPAC codes) are left out.
+
+    Only the exon regions are read from the reference FASTA, using its FAI index. Chromosome names are matched with or
+    without a leading 'chr', so a GTF using 'chr2' works with a FASTA using '2' and vice versa. An error is raised if
+    the index ends up empty or if any gene gets no k-mers (e.g. its chromosome is named differently in the FASTA, or
+    its exons are shorter than kmer_size), since the screen would otherwise quietly report nonsense.
+
+    :param exons: A list of (seqname, start, end, gene_name) tuples, as returned by read_exons.
+    :param reference_genome_fasta: path/to/the/reference.fa, with its FAI index.
+    :param kmer_size: The length of the k-mers.
+    :return: A tuple (index, gene_list), where index maps each canonical k-mer to the position of its gene in
+    gene_list, or to -1 if it is shared by several genes.
+    """
+    fasta_index = read_fasta_index(reference_genome_fasta)
+    gene_list = sorted(set(exon[3] for exon in exons))
+    gene_positions = {gene_name: position for position, gene_name in enumerate(gene_list)}
+    index = {}
+    indexed_genes = set()
+
+    with open(r'%s' % reference_genome_fasta, 'rb') as fasta:
+        for seqname, start, end, gene_name in exons:
+            fasta_index_entry = fasta_index.get(seqname.replace('chr', '', 1))
+            if fasta_index_entry is None:
+                continue
+            exon_sequence = fetch_region(fasta, fasta_index_entry, start, end)
+            reverse_sequence = exon_sequence.translate(COMPLEMENT)[::-1]
+            length = len(exon_sequence)
+            for i in range(length - kmer_size + 1):
+                kmer = min(exon_sequence[i:i + kmer_size], reverse_sequence[length - i - kmer_size:length - i])
+                if 'N' in kmer:
+                    continue
+                indexed_genes.add(gene_name)
+                if index.get(kmer, gene_positions[gene_name]) != gene_positions[gene_name]:
+                    index[kmer] = -1
+                else:
+                    index[kmer] = gene_positions[gene_name]
+
+    if len(index) == 0:
+        raise ValueError("The fast screen's k-mer index is empty: none of the gene exons in the GTF could be found in "
+                         "%s. Check that the GTF and the FASTA use the same chromosome names." % reference_genome_fasta)
+    missing_genes = [gene_name for gene_name in gene_list if gene_name not in indexed_genes]
+    if missing_genes:
+        raise ValueError("No %s-mers could be taken from the exons of %s in %s. Check that the GTF and the FASTA use "
+                         "the same chromosome names and that the k-mer size is not longer than the exons."
+                         % (kmer_size, ', '.join(missing_genes), reference_genome_fasta))
+
+    return index, gene_list
+
+
+def init_screen_worker(index, kmer_size):
+    """
+    Store the k-mer index in a fast screen worker process. Workers are forked, so the index is shared with the parent
+    rather than copied through a pipe.
+    """
+    global screen_index, screen_kmer_size
+    screen_index = index
+    screen_kmer_size = kmer_size
+
+
+def screen_reads(reads, min_hits=2):
+    """
+    Assign a batch of reads to genes of the fast screen's k-mer index. K-mers are sampled every half k-mer along each
+    read (and at its end), and each hit votes for its gene. A read is assigned to the gene with the most votes if it
+    has at least min_hits of them and no other gene has as many.
+
+    :param reads: A list of read sequences.
+    :param min_hits: The number of k-mer hits needed to assign a read.
+    :return: A tuple (counts, no_features, ambiguous): a Counter of reads per gene position, the number of reads with
+    too few hits, and the number of reads tied between genes.
+    """
+    counts = Counter()
+    no_features = 0
+    ambiguous = 0
+    step = max(1, screen_kmer_size // 2)
+    for read in reads:
+        length = len(read)
+        if length < screen_kmer_size:
+            no_features += 1
+            continue
+        reverse_read = read.translate(COMPLEMENT)[::-1]
+        positions = list(range(0, length - screen_kmer_size + 1, step))
+        if positions[-1] != length - screen_kmer_size:
+            positions.append(length - screen_kmer_size)
+        votes = Counter()
+        for i in positions:
+            kmer = min(read[i:i + screen_kmer_size], reverse_read[length - i - screen_kmer_size:length - i])
+            gene = screen_index.get(kmer, -1)
+            if gene != -1:
+                votes[gene] += 1
+        top_votes = votes.most_common(2)
+        if len(top_votes) == 0 or top_votes[0][1] < min_hits:
+            no_features += 1
+        elif len(top_votes) == 2 and top_votes[1][1] == top_votes[0][1]:
+            ambiguous += 1
+        else:
+            counts[top_votes[0][0]] += 1
+    return counts, no_features, ambiguous
+
+
+def read_fastq_batches(fastq_paths, batch_size=20000):
+    """
+    Stream the read sequences of one or more FASTQ or FASTQ.gz files in upper case, in batches of batch_size reads.
+    """
+    batch = []
+    for fastq_path in fastq_paths:
+        if fastq_path.endswith('.gz'):
+            fastq = gzip.open(r'%s' % fastq_path, 'rt')
+        else:
+            fastq = open(r'%s' % fastq_path, 'r')
+        with fastq:
+            for line_number, line in enumerate(fastq):
+                if line_number % 4 == 1:
+                    batch.append(line.rstrip().upper())
+                    if len(batch) == batch_size:
+                        yield batch
+                        batch = []
+    if batch:
+        yield batch
+
+
+def screen_fastq(fastq_paths, annotation_gtf, reference_genome_fasta, resource_directory, filepath, samplename,
+                 kmer_size, workers):
+    """
+    Alignment-free fast screen. Builds a k-mer index of the IG variable and constant genes and the known contaminant
+    genes listed in the resource directory, using their exons in annotation_gtf and their sequence in the reference
+    FASTA, then streams the FASTQ reads against it with several worker processes.
+
+    The counts are written in the same format as featureCounts's output (samplename.txt and samplename.txt.summary),
+    so that interpret_featurecounts can be run on them with screening=True. The HEAVY/KAPPA/LAMBDA locus rows are the
+    sums of the reads assigned to the V and C genes of each locus, so, unlike with featureCounts, reads from J/D genes
+    and introns are not included. Each FASTQ file is counted separately, so both reads of a pair are counted.
+
+    :param fastq_paths: A list of FASTQ or FASTQ.gz files of the sample.
+    :param annotation_gtf: The GTF giving the exons of the genes.
+    :param reference_genome_fasta: The reference FASTA matching annotation_gtf.
+    :param resource_directory: The directory from which the gene lists will be sourced.
+    :param filepath: The directory in which the count files will be written.
+    :param samplename: The name of the sample.
+    :param kmer_size: The length of the k-mers.
+    :param workers: The number of worker processes.
+    :return: No return, but two files will be written.
+    """
+    locus_lists = {'HEAVY_Locus': ['IgH_Variable_Genes.txt', 'IgH_Constant_Genes.txt'],
+                   'KAPPA_Locus': ['IgK_Variable_Genes.txt', 'IgK_Constant_Genes.txt'],
+                   'LAMBDA_Locus': ['IgL_Variable_Genes.txt', 'IgL_Constant_Genes.txt']}
+    locus_genes = {}
+    for locus, gene_files in locus_lists.items():
+        locus_genes[locus] = set()
+        for gene_file in gene_files:
+            locus_genes[locus].update(open(r'%s/%s' % (resource_directory, gene_file), 'r').read().split())
+    gene_names = set(open(r'%s/Non_Bcell_Contamination_GeneList_e98.txt' % resource_directory, 'r').read().split())
+    for genes in locus_genes.values():
+        gene_names.update(genes)
+
+    print('%s: Building %s-mer index' % (samplename, kmer_size))
+    exons = read_exons(annotation_gtf, gene_names)
+    index, gene_list = build_kmer_index(exons, reference_genome_fasta, kmer_size)
+    print('%s: Index holds %s k-mers from %s genes' % (samplename, len(index), len(gene_list)))
+
+    # Fork the workers so that they share the index with this process instead of receiving a copy
+    print('%s: Screening reads' % samplename)
+    counts = Counter()
+    no_features = 0
+    ambiguous = 0
+    with multiprocessing.get_context('fork').Pool(max(1, workers), initializer=init_screen_worker,
+                                                  initargs=(index, kmer_size)) as pool:
+        for batch_counts, batch_no_features, batch_ambiguous in pool.imap_unordered(screen_reads,
+                                                                                    read_fastq_batches(fastq_paths)):
+            counts.update(batch_counts)
+            no_features += batch_no_features
+            ambiguous += batch_ambiguous
+
+    # Gene coordinates and lengths are given as featureCounts gives them for a meta-feature: the exons' chromosome,
+    # start and end, and the number of bases covered by at least one exon.
+    gene_exons = {}
+    for seqname, start, end, gene_name in exons:
+        gene_exons.setdefault(gene_name, []).append((seqname, start, end))
+
+    def gene_length(intervals):
+        length = 0
+        covered_to = 0
+        for seqname, start, end in sorted(intervals, key=lambda interval: interval[1]):
+            if end > covered_to:
+                length += end - max(start, covered_to + 1) + 1
+                covered_to = end
+        return length
+
+    with open(r'%s/%s.txt' % (filepath, samplename), 'w') as counts_file:
+        counts_file.write('# Program:MARS fast screen; k-mer size %s; Command:"%s"\n' % (kmer_size, ' '.join(sys.argv)))
+        counts_file.write('Geneid\tChr\tStart\tEnd\tStrand\tLength\t%s\n' % ','.join(fastq_paths))
+        for position, gene_name in enumerate(gene_list):
+            intervals = gene_exons[gene_name]
+            counts_file.write('%s\t%s\t%s\t%s\t.\t%s\t%s\n'
+                              % (gene_name, intervals[0][0], min(interval[1] for interval in intervals),
+                                 max(interval[2] for interval in intervals), gene_length(intervals), counts[position]))
+        for locus, genes in locus_genes.items():
+            locus_count = sum(counts[position] for position, gene_name in enumerate(gene_list) if gene_name in genes)
+            locus_length = sum(gene_length(gene_exons[gene_name]) for gene_name in gene_list if gene_name in genes)
+            counts_file.write('%s\t.\t.\t.\t.\t%s\t%s\n' % (locus, locus_length, locus_count))
+
+    with open(r'%s/%s.txt.summary' % (filepath, samplename), 'w') as summary_file:
+        summary_file.write('Status\t%s\n' % ','.join(fastq_paths))
+        summary_file.write('Assigned\t%s\n' % sum(counts.values()))
+        summary_file.write('Unassigned_Ambiguity\t%s\n' % ambiguous)
+        summary_file.write('Unassigned_NoFeatures\t%s\n' % no_features)
+
+
+async def interpret_and_render(scheduler, samplename, annotation_label=None, screening=False):
+    """
+    Interpret the featureCounts output of a sample (or of one of its annotation variants), plot it in R and remove the
+    temporary files written along the way.
+
+    :param scheduler: The StageScheduler shared by all samples.
+    :param samplename: The name of the sample.
+    :param annotation_label: The label of the annotation variant, if several annotations were counted at once.
+    :param screening: True if the counts come from the fast screen.
+    :return: No return, but the output files will be written.
+    """
+    if annotation_label is None:
+        fileprefix = samplename
+    else:
+        fileprefix = '%s_%s' % (samplename, annotation_label)
+
+    # Run the interpret_featurecounts function on featureCounts's output. Neither this nor the R script takes a thread
+    # from the -t budget, which is left to samtools and featureCounts.
+    await scheduler.run_function('interpret', 'cpu', interpret_featurecounts, out_path, resource_directory,
+                                 samplename, annotation_label, screening, threads=0)
+
+    # Call the R script to produce the visual outputs
+    returncode = await scheduler.run_command('render', 'io', 'R <%s/igh_graph.R --no-save %s %s %s'
+                                             % (resource_directory, resource_directory, out_path, fileprefix), 0)
+    if returncode != 0:
+        raise RuntimeError("R exited with status %s while plotting %s" % (returncode, fileprefix))
+
+    # Remove temporary files if desired
+    if keep_temp is False:
+        os.remove(r'%s/%sGraph_IgH.txt' % (out_path, fileprefix))
+        os.remove(r'%s/%sGraph_IgL.txt' % (out_path, fileprefix))
+        os.remove(r'%s/%stitle.txt' % (out_path, fileprefix))
+
+
+async def process_sample(scheduler, input_aln, samplename, annotation_gtf, annotation_labels, job_threads):
+    """
+    Take one sample through every stage of the program: CRAM conversion (if needed), featureCounts, interpretation of
+    the counts, plotting in R and removal of temporary files. Each stage waits its turn in the scheduler, so several
+    calls to this function can run side by side on different samples.
+
+    :param scheduler: The StageScheduler shared by all samples.
+    :param input_aln: The SAM, BAM or CRAM file of the sample.
+    :param samplename: The name of the sample.
+    :param annotation_gtf: The GTF passed to featureCounts.
+    :param annotation_labels: The labels of the annotation variants merged into annotation_gtf, or None if it holds a
+    single annotation.
+    :param job_threads: The number of threads given to each multi-threaded tool.
+    :return: No return, but the output files of the sample will be written.
+    """
+    in_bam = await read_aln_file(scheduler, input_aln, samplename, job_threads, out_path,
+                                 reference_genome_fasta=ref_fasta)
+
+    try:
+        # Direct shell to scratch for universal usage capabilities
+        returncode = await scheduler.run_command('featureCounts', 'cpu',
+                                                 "%s -g gene_name -O -s 0 -Q 10 -T %s -C -p -a %s -o %s/%s.txt %s"
+                                                 % (featurecounts_path, job_threads, annotation_gtf, out_path,
+                                                    samplename, in_bam),
+                                                 job_threads)
+        if returncode != 0:
+            raise RuntimeError("featureCounts exited with status %s for %s" % (returncode, input_aln))
+
+        if annotation_labels is None:
+            await interpret_and_render(scheduler, samplename)
+        else:
+            await scheduler.run_function('split', 'io', split_featurecounts, out_path, samplename, annotation_labels,
+                                         threads=0)
+            # Let every label finish before reporting a failure, so that no stage is left running unattended
+            results = await asyncio.gather(*[interpret_and_render(scheduler, samplename, label)
+                                             for label in annotation_labels], return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+    finally:
+        # Remove the BAM converted from a CRAM if desired, even if counting, interpreting or plotting failed
+        if keep_temp is False and os.path.splitext(input_aln)[1] == ".cram":
+            os.remove(r'%s' % in_bam)
+            os.remove(r'%s.bai' % in_bam)
+
+
+async def run_pipeline(input_alns, sample_names, annotation_gtf, annotation_labels=None):
+    """
+    Pipeline the samples through process_sample, sharing one StageScheduler built from the -t, -io_jobs and -cpu_jobs
+    arguments. At most one sample per I/O and CPU slot is in flight at a time, so that samples already converted are
+    finished (and their converted BAM removed) before more conversions start. A failing sample does not stop the
+    others.
+
+    :param input_alns: The list of input alignment files.
+    :param sample_names: The list of sample names, in the same order as input_alns.
+    :param annotation_gtf: The GTF passed to featureCounts.
+    :param annotation_labels: The labels of the annotation variants merged into annotation_gtf, if any.
+    :return: A list of (sample name, exception) tuples for the samples that failed.
+    """
+    scheduler = StageScheduler(threads, io_jobs, cpu_jobs)
+    samples_in_flight = max(1, io_jobs) + max(1, cpu_jobs)
+    admission = asyncio.Semaphore(samples_in_flight)
+    # Split the thread budget between the samples in flight. A single sample runs its stages one after another, so it
+    # gets every thread, as before.
+    job_threads = max(1, threads // min(len(input_alns), samples_in_flight))
+    if len(input_alns) > 1 and threads < 2:
+        print('WARNING: with -t 1, CRAM conversion and featureCounts of different samples cannot overlap; '
+              'only interpretation and plotting will run alongside them. Use -t 2 or more to pipeline samples fully.')
+
+    async def admit_sample(aln, name):
+        async with admission:
+            await process_sample(scheduler, aln, name, annotation_gtf, annotation_labels, job_threads)
+
+    results = await asyncio.gather(*[admit_sample(aln, name) for aln, name in zip(input_alns, sample_names)],
+                                   return_exceptions=True)
+    scheduler.report()
+    return [(name, result) for name, result in zip(sample_names, results) if isinstance(result, Exception)]
+
+
+async def run_screen(samplename):
+    """
+    Interpret and plot the counts written by the fast screen (screen_fastq), flagged as a screening result.
+
+    :param samplename: The name of the sample.
+    :return: A list of (sample name, exception) tuples, holding the sample if it failed.
+    """
+    scheduler = StageScheduler(threads, io_jobs, cpu_jobs)
+    try:
+        await interpret_and_render(scheduler, samplename, screening=True)
+    except Exception as e:
+        return [(samplename, e)]
+    finally:
+        scheduler.report()
+    return []
+
+
 # ------------------------------------------------------------------------------------------------------------------- #
 # CODE THAT ACTUALLY RUNS THINGS
 # ------------------------------------------------------------------------------------------------------------------- #
 
-in_bam = read_aln_file(input_aln, threads, out_path, reference_genome_fasta=ref_fasta)
-
 # Case where user wants to build an IG GTF from a different GTF than provided. In this case, the program builds
 # the GTF and then processes the input BAM using the new GTF
 if in_gtf is not None and build is True:
@@ -649,9 +1373,7 @@ if in_gtf is not None and build is True:
             os.remove(r'%s/%s.csv' % (out_path, samplename))
         sys.exit(0)
 
-    # Direct shell to scratch for universal usage capabilities
-    call("%s -g gene_name -O -s 0 -Q 10 -T %s -C -p -a %s/%s.gtf -o %s/"
-         "%s.txt %s" % (featurecounts_path, threads, out_path, samplename, out_path, samplename, in_bam), shell=True)
+    annotation_gtf = '%s/%s.gtf' % (out_path, samplename)
 
 # Case where the user wants to build a new GTF but no starting GTF is provided. In this case, an error is thrown, since
 # there will be nothing to build from
@@ -664,50 +1386,48 @@ elif in_gtf is None and build is True:
 # ensuring the GTF cooperates with the rest of the program and their goals is their responsibility.
 elif in_gtf is not None and build is False:
 
-    # Run featurecounts from the shell
-    call("%s -g gene_name -O -s 0 -Q 10 -T %s -C -p -a %s -o %s/"
-         "%s.txt %s" % (featurecounts_path, threads, in_gtf, out_path, samplename, in_bam), shell=True)
+    annotation_gtf = in_gtf
 
 # Case where no inputs except BAM are given and the build command is not called. In this case, it is assumed that the
 # user wants to use the default GTF provided with the script.
 else:
 
-    # Run featurecounts from the shell
-    #try:
-        #call("featureCounts -g gene_name -O -s 0 -Q 10 -T %s -C -p -a %s/%s.gtf -o %s/"
-             #"%s.txt %s" % (threads, resource_directory, default_gtf, out_path, samplename, in_bam),
-             #shell=True)
-    #except:
-        #print('EXCEPT STATEMENT EXECUTED')
-    call("%s -g gene_name -O -s 0 -Q 10 -T %s -C -p -a %s/%s.gtf -o %s/"
-        "%s.txt %s" % (featurecounts_path, threads, resource_directory, default_gtf, out_path, samplename, in_bam),
-        shell=True)
-
-# Run the interpret_featurecounts function on featureCounts's output
-interpret_featurecounts('%s' % out_path, '%s' % resource_directory, '%s' % samplename)
-
-# Call the R script to produce the visual outputs
-call('R <%s/igh_graph.R --no-save %s %s %s' % (resource_directory, resource_directory, out_path, samplename),
-     shell=True)
-
-# Remove temporary files if desired
-if keep_temp is True:
-    pass
-elif keep_temp is False and build is True:
-    if os.path.splitext(input_aln)[1] == ".cram":
-        os.remove(r'%s/%s.bam' % (out_path, samplename))
-        os.remove(r'%s/%s.bam.bai' % (out_path, samplename))
-    os.remove(r'%s/%sGraph_IgH.txt' % (out_path, samplename))
-    os.remove(r'%s/%sGraph_IgL.txt' % (out_path, samplename))
-    os.remove(r'%s/%stitle.txt' % (out_path, samplename))
-    os.remove(r'%s/%s.csv' % (out_path, samplename))
+    annotation_gtf = '%s/%s.gtf' % (resource_directory, default_gtf)
+
+# Case where additional annotations are given. The annotation chosen above and the additional ones are merged into a
+# single GTF so that featureCounts counts every variant in one pass over each alignment.
+if annotation_sets:
+    annotation_sets.insert(0, ('primary', annotation_gtf))
+    annotation_labels = [label for label, annotation_path in annotation_sets]
+    annotation_gtf = '%s/%s_annotations.gtf' % (out_path, samplename)
+    merge_annotations(annotation_sets, annotation_gtf)
 else:
-    if os.path.splitext(input_aln)[1] == ".cram":
-        os.remove(r'%s/%s.bam' % (out_path, samplename))
-        os.remove(r'%s/%s.bam.bai' % (out_path, samplename))
-    os.remove(r'%s/%sGraph_IgH.txt' % (out_path, samplename))
-    os.remove(r'%s/%sGraph_IgL.txt' % (out_path, samplename))
-    os.remove(r'%s/%stitle.txt' % (out_path, samplename))
+    annotation_labels = None
 
-sys.exit(0)
+# Run the fast screen on the FASTQ files if given, otherwise run every sample through conversion, featureCounts,
+# interpretation and plotting. The screen is run before the event loop starts, since its worker processes are forked
+# and forking while the loop's threads are running could deadlock them.
+if fastqs is not None:
+    try:
+        screen_fastq(fastqs, annotation_gtf, ref_fasta, resource_directory, out_path, samplename, screen_kmer, threads)
+    except Exception as e:
+        failed_samples = [(samplename, e)]
+    else:
+        failed_samples = asyncio.run(run_screen(samplename))
+else:
+    failed_samples = asyncio.run(run_pipeline(input_alns, sample_names, annotation_gtf, annotation_labels))
+
+# Remove the merged annotation GTF if desired
+if keep_temp is False and annotation_labels is not None:
+    os.remove(r'%s' % annotation_gtf)
+
+# Remove the CSV used to build the GTF if desired
+if keep_temp is False and build is True:
+    os.remove(r'%s/%s.csv' % (out_path, samplename))
+
+if failed_samples:
+    for name, error in failed_samples:
+        print('ERROR: sample %s failed: %s' % (name, error))
+    sys.exit(1)
 
+sys.exit(0)